@@ -12,10 +12,46 @@ liangting.zj@gmail.com
 
 from __future__ import division, print_function
 import numpy as np
-import sys
+import sys, os, time
+from subprocess import call
+from concurrent.futures import ThreadPoolExecutor
+from scipy.fft import next_fast_len, rfft
+from scipy.ndimage import gaussian_filter1d
+from force_calculate import fcCalc
 
 __all__ = ["SHCPostProc"]
 
+def _shcKernel():
+    """
+    Return the numba-compiled kernel computing dots_imag[ki] = Im(velsL[:, ki] * Kij * conj(velsR[:, ki])) for every
+    frequency ki, with velsL = velFFT[rowsL] and velsR = velFFT[rowsR] read on the fly (no gathered copies or temporaries).
+    numba is imported here only, i.e. only if useNumba is set.
+    """
+    from numba import njit, prange
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def shcImagDots(velFFT, Kij, rowsL, rowsR, dots_imag, blockSize=64):
+        Nfreqs = velFFT.shape[1]
+        NBlocks = (Nfreqs + blockSize - 1) // blockSize
+        for kb in prange(NBlocks):                            # Blocks of frequencies in parallel
+            k0 = kb * blockSize
+            k1 = min(k0 + blockSize, Nfreqs)
+            for ki in range(k0, k1):
+                dots_imag[ki] = 0.0
+            for a in range(rowsL.shape[0]):
+                ra = rowsL[a]
+                for b in range(rowsR.shape[0]):
+                    rb = rowsR[b]
+                    K = Kij[a, b]
+                    if K == 0.0:
+                        continue
+                    for ki in range(k0, k1):                  # Contiguous in velFFT
+                        vL = velFFT[ra, ki]
+                        vR = velFFT[rb, ki]
+                        dots_imag[ki] += K * (vL.imag * vR.real - vL.real * vR.imag)
+
+    return shcImagDots
+
 class SHCPostProc(object):
     """
     Compute the spectral decomposition of heat current from the data
@@ -24,7 +60,9 @@ class SHCPostProc(object):
     The velocities are read from the "compact" file produced with the C++-code
     compactify_vels.cpp from a LAMMPS dump file. If the dump file does not exist,
     it is produced by calling the binary ``compactify_vels``,
-    which must be found in the environment's ``$PATH``.
+    which must be found in the environment's ``$PATH``. The ASCII compact file is
+    transcoded once into a binary file (``Compact_VelocityFile + '.bin'``) laid out
+    chunk by chunk, which is then streamed in the post-processing.
     
     Minimal usage in Python::
         pP = SHCPostProc(Compact_VelocityFile, Kij_FilePrefix)    *** Gets all the attributes in the class ***
@@ -32,7 +70,6 @@ class SHCPostProc(object):
         
     Public attributes::
         - SHC_smooth (numpy float array): The chunk-averaged, smoothened spectral heat current
-        - SHC_smooth2 (numpy float array): Square of the chunk-averaged, smoothened spectral heat current, used for estimating the error from the between-chunk variance
         - SHC_average (numpy float array): The chunk-averaged spectral heat current without smoothing
         - SHC_error (numpy float array): The estimated error from the between-chunk variance, None if only one chunk evaluated
         - oms_fft (numpy float array): The angular frequency grid (in the units of Hz if dt_md is given in the units of seconds in the initialization)
@@ -64,14 +101,20 @@ class SHCPostProc(object):
                                  (2) This parameter is required if the force constant file does not exist (default None).
            - widthWin (float): Use this width for the smoothing window (Hz) (default 1.0) (1 THz = 1 × 10^12 Hz)
            - NChunks (int): The number of chunks to be read, this should be set to a sufficiently large value if the whole velocity file should be read (default 20)
-           - chunkSize (int): (1) Used chunk size for reading the velocities, affects the frequency grid. 
-                              (2) Performing FFT is faster if chunkSize is a power of 2.
+           - chunkSize (int): (1) Used chunk size for the FFT of the velocities, affects the frequency grid. 
+                              (2) The int(steps / dn / NChunks) velocity frames read per chunk are zero-padded
+                                  up to chunkSize = next_fast_len(int(steps / dn / NChunks)), since performing FFT is
+                                  much faster if chunkSize only has small prime factors.
                               (3) It affects the maximum frequency that can be reached 
-                              (4) chunkSize = int(steps / dn / NChunks)
            - sampleTimestep (float): (1) This is the time interval in units of seconds between two frames of velocity data you save.
                                      (2) Its reciprocal divided by 2 is roughly the maximum frequency attainable.
-           - backupPrefix (str): Prefix for pickling the post-processing object to a file after the read of each chunk (default None)
+           - backupPrefix (str): Prefix for the backup file backupPrefix_backup.npz, written after the read of each chunk with the frequency grid (oms), the running averages (smooth, average), the sum of squared deviations (M2) and the number of chunks read (chunks) (default None)
            - hstep (float): The displacement used in calculating the force constants by the finite-displacement method (default 0.01)
+           - fftWorkers (int): Number of threads used by scipy.fft over the degrees of freedom, negative values count from os.cpu_count() (default -1, i.e. all cores)
+           - useFFTW (boolean): Use a pyFFTW plan (created once, reused for every chunk) instead of scipy.fft, requires the pyfftw package (default False)
+           - useNumba (boolean): Compute the spectral heat current with a parallel kernel compiled by numba instead of the BLAS matrix products, requires the numba package (default False)
+           - maxFreq (float): Highest angular frequency (in the units of oms_fft, rad/s) kept after the FFT; the spectral heat current is only computed on the frequency grid up to maxFreq, which reduces the matrix products accordingly (default None, i.e. up to the Nyquist frequency)
+           - useGPU (boolean): Compute the FFT (cuFFT) and the spectral heat current (cuBLAS) on the GPU, requires the cupy package. useFFTW and useNumba are ignored if set (default False)
     """
 
     def __init__(self, Compact_VelocityFile, Kij_FilePrefix, in_plane=False, out_of_plane=False, reCalcVels=False, reCalcFC=False, **args):  
@@ -80,6 +123,7 @@ class SHCPostProc(object):
         
         # Attributes set by positional arguments
         self.compactVelocityFile = Compact_VelocityFile       # For velocity
+        self.binaryVelocityFile = Compact_VelocityFile + '.bin'  # Binary copy of the compact file (read in postProcess)
         self.KijFilePrefix = Kij_FilePrefix                   # For atoms forces
 
         # Attributes set by keyword parameters below
@@ -93,10 +137,15 @@ class SHCPostProc(object):
         self.LAMMPSDumpFile = None                            # LAMMPS dump file of Velocity
         self.LAMMPSInFile = None                              # LAMMPS input file (For generate the forces)
         self.widthWin = 1.0                                   # Default  (Hz) 
+        self.maxFreq = None                                   # Default (rad/s, up to the Nyquist frequency)
         self.hstep = 0.01                                     # Default (For calculate the force constant)
         self.reCalcVels = reCalcVels                          # Boolean
         self.reCalcFC = reCalcFC                              # Boolean
         self.backupPrefix = None                              # For backup
+        self.fftWorkers = -1                                  # Default (use all the cores for the FFT)
+        self.useFFTW = False                                  # Default (use scipy.fft)
+        self.useNumba = False                                 # Default (use BLAS)
+        self.useGPU = False                                   # Default (use the CPU)
 
         self.in_plane = in_plane
         self.out_of_plane = out_of_plane                      # For different directions
@@ -107,16 +156,29 @@ class SHCPostProc(object):
         self.ids_R = None
         self.NL = None
         self.NR = None
+        self._rowsL = None                                    # Rows of the left atoms' degrees of freedom in the velocity array
+        self._rowsR = None                                    # Rows of the right atoms' degrees of freedom in the velocity array
         self.inds_interface = None                            # Used to compare with the atomic index in the dump_velovity file
         
         self.velsL = None                                     # It stores the atomic velocity on the left
         self.velsR = None                                     # It stores the atomic velocity on the right
         
+        self._fftIn = None                                    # Aligned input/output buffers and plan of pyFFTW (useFFTW)
+        self._fftOut = None
+        self._fftPlan = None
+        
+        self._dVel = None                                     # Velocity buffer, Kij and rowsL/R resident on the GPU (useGPU)
+        self._dKij = None
+        self._dRowsL = None
+        self._dRowsR = None
+        
         self.SHC_smooth = None
-        self.SHC_smooth2 = None
+        self._M2 = None                                       # Running sum of squared deviations of the smoothened SHC (Welford)
         self.SHC_average = None
         self.SHC_error = None
         self.oms_fft = None
+        self._sigmaBins = None                                # Width of the Gaussian smoothing window on the oms_fft grid
+        self._omsCalc = None                                  # Frequencies computed per chunk: oms_fft plus the smoothing margin above maxFreq
 
         for key, value in args.items():
             if not hasattr(self, key):
@@ -127,7 +189,9 @@ class SHCPostProc(object):
         # MD attributes that need to be defined based on the input attributes    
         # MD Attributes   
         
-        self.chunkSize = int(self.steps/self.dn/self.NChunks)
+        self._chunkFrames = int(self.steps/self.dn/self.NChunks)             # Number of velocity frames per chunk in the binary file
+        self._rawChunk = self._chunkFrames                                   # Number of velocity frames read per chunk
+        self.chunkSize = next_fast_len(self._rawChunk, real=True)            # Zero-padded FFT length
         
         '''
         This is the time interval in units of seconds between two frames of velocity data you save.
@@ -139,7 +203,6 @@ class SHCPostProc(object):
         print('\nEffective timestep for velocity data is ' + str(self.sampleTimestep) + ' (s)')
  
      
-        import os
         if self.reCalcVels or not os.path.isfile(self.compactVelocityFile):  # Check if the velocity file exists
             # Check that the LAMMPS Dump file exists
             if self.LAMMPSDumpFile is None or not os.path.isfile(self.LAMMPSDumpFile):
@@ -152,6 +215,14 @@ class SHCPostProc(object):
         else:
             print('\n' + self.compactVelocityFile + " exists, using the file for post-processing.")
 
+        # Transcode the ASCII compact file to binary once (or again if the compact file is newer or the chunks differ)
+        if (not os.path.isfile(self.binaryVelocityFile) or
+                os.path.getmtime(self.binaryVelocityFile) < os.path.getmtime(self.compactVelocityFile) or
+                self._readBinaryHeader(self.binaryVelocityFile)[2] != self._chunkFrames):
+            self._binarizeVels(self.compactVelocityFile, self.binaryVelocityFile, self._chunkFrames)
+        else:
+            print('\n' + self.binaryVelocityFile + " exists, using the file for post-processing.")
+
         # Check the force constant file
         if self.reCalcFC or not os.path.isfile(self.KijFilePrefix + '.Kij.npy'):   # Check if the force constant file exists
             print("\nCreating file " + self.KijFilePrefix + ".")
@@ -160,6 +231,10 @@ class SHCPostProc(object):
             self._calcFC(self.KijFilePrefix, self.LAMMPSInFile)
         else:  # Load the force constants from file
             self._loadFC(self.KijFilePrefix)
+            
+        ## For different direction spectral SHC (Kij is masked once for all the chunks)
+        if self.in_plane or self.out_of_plane:
+            self._differ_direction()
 
     def __enter__(self):
         return self
@@ -174,9 +249,7 @@ class SHCPostProc(object):
         elapsted time will be printed to screen and optionally (by default) written
         to 'log.txt' file.
         """
-        import time
-        global startTime_for_tictoc
-        startTime_for_tictoc = time.time()
+        self._t0 = time.perf_counter()                  # Per instance, no global state
         
     def _toc(self):
         """
@@ -185,23 +258,19 @@ class SHCPostProc(object):
         elapsted time will be printed to screen and optionally (by default) written
         to 'log.txt' file.
         """
-        import time
-        if 'startTime_for_tictoc' in globals():
-            print(("\nThe time it takes to run the program is: "+
-              str(np.round(time.time()-
-                       startTime_for_tictoc,decimals=3))+" seconds."))
-        else:
-            print("\nToc: start time not set") 
+        print(("\nThe time it takes to run the program is: "+
+              str(np.round(time.perf_counter()-
+                       self._t0,decimals=3))+" seconds.")) 
 
     def _calcFC(self, fileprefix, LAMMPSInFile):
     	
-        from force_calculate import fcCalc
         with fcCalc(fileprefix) as fc:
             fc.preparelammps(in_lammps = LAMMPSInFile, w_interface = 6.0)
             fc.fcCalc(self.hstep)
             fc.writeToFile()
             print('Force constant matrix file generate done')
-            self.Kij = fc.Kij                                  # Reference (get Force constant matrix)
+            self.Kij = np.ascontiguousarray(fc.Kij, dtype=np.float32)   # Force constant matrix (single precision is enough for finite differences)
+            assert self.Kij.flags['C_CONTIGUOUS']              # Row-major for the matrix products
             print("\nSize of the Kij file is (3 * %d) x (3 * %d)." % (np.size(self.Kij, 0) / 3, np.size(self.Kij, 1) / 3)) # Get the number of rows(0) and columns(1) of a matrix
             self.ids_L = fc.ids_L                              # Reference (get the left interfacial atom indices)
             self.ids_R = fc.ids_R                              # Reference (get the right interfacial atom indices)
@@ -212,13 +281,17 @@ class SHCPostProc(object):
             if (np.size(self.Kij, 0) / 3 != self.NL) or (np.size(self.Kij, 1) / 3 != self.NR):
                 raise ValueError("Sizes in Kij and ids_L/R do not match!")
             
+            self._rowsL = self._dofRows(self.ids_L)
+            self._rowsR = self._dofRows(self.ids_R)
+            
             self.inds_interface = fc.inds_interface            # Used to compare with the atomic index in the dump_velovity file
                  
 
     def _loadFC(self, KijFilePrefix):
     	
         print("\nLoading the force constants from " + KijFilePrefix + '.Kij.npy')
-        self.Kij = np.load(KijFilePrefix + '.Kij.npy')
+        self.Kij = np.ascontiguousarray(np.load(KijFilePrefix + '.Kij.npy'), dtype=np.float32)   # Single precision is enough for finite differences
+        assert self.Kij.flags['C_CONTIGUOUS']                  # Row-major for the matrix products
         print("\nSize of the Kij file is (3*%d)x(3*%d)." % (np.size(self.Kij, 0) / 3, np.size(self.Kij, 1) / 3))
         
         print("\nLoading left interfacial atom indices from " + KijFilePrefix + '.ids_L.npy')
@@ -232,6 +305,9 @@ class SHCPostProc(object):
         #print("\nlen(ids_R) = %d" % self.NR)
         if (np.size(self.Kij, 0) / 3 != self.NL) or (np.size(self.Kij, 1) / 3 != self.NR):
             raise ValueError("Sizes in Kij and ids_L/R do not match!")
+        
+        self._rowsL = self._dofRows(self.ids_L)
+        self._rowsR = self._dofRows(self.ids_R)
             
         # Used to compare with the atomic index in the dump_velovity file 
         print("\nLoading interface group\'s atom indices from " + KijFilePrefix + '.ids_Interface.npy') 
@@ -239,223 +315,358 @@ class SHCPostProc(object):
     
     def _compactVels(self, file_Vels, finalFile_Vels):
     	
-        from subprocess import call
         command = ["compactify_vels", file_Vels, finalFile_Vels]
         print("\nRunning the " + '\"' + " ".join(command) + '\"' + ' command to generate the compact_velocity file.')
         call(command)
 
-    def _smoothen(self, func, df, widthWin):
+    def _dofRows(self, ids):
+        """
+        Return the rows of the x, y and z degrees of freedom of the atoms ``ids`` in the velocity array,
+        interleaved in the same order as the rows and columns of Kij.
+        """
+        rows = np.empty(3 * len(ids), dtype=np.intp)
+        rows[0::3] = 3 * ids                                      # X-direction
+        rows[1::3] = 3 * ids + 1                                  # Y-direction
+        rows[2::3] = 3 * ids + 2                                  # Z-direction
+        return rows
+
+    def _readBinaryHeader(self, binaryFile):
+        """
+        Return Natoms, d_timestep and the number of frames per chunk from the header of the binary velocity file.
+        """
+        with open(binaryFile, 'rb') as fid:
+            header = np.frombuffer(fid.read(12), dtype='<i4')
+        if np.size(header) != 3:
+            return None, None, None
+        return [int(n) for n in header]
+
+    def _binarizeVels(self, compactFile, binaryFile, chunkFrames):
+        """
+        Transcode the ASCII compact velocity file into a binary file, which is laid out as
+        Natoms (int32), d_timestep (int32), chunkFrames (int32), atom ids (int32[Natoms]) and the velocities (float64),
+        all little-endian and packed contiguously. The velocities are stored in chunks of chunkFrames frames (the last
+        chunk may be shorter), and within a chunk degree of freedom by degree of freedom
+        ([dof0_t0, dof0_t1, ..., dof1_t0, ...]), so that a chunk is read directly as a C-ordered (NDOF, chunkFrames) array.
+        The file is written to binaryFile + '.tmp' and only moved to binaryFile once complete, so an interrupted
+        transcoding never leaves a truncated binaryFile behind.
+        """
+        print("\nTranscoding " + compactFile + " to the binary file " + binaryFile + ".")
+        tmpFile = binaryFile + '.tmp'
+        with open(compactFile, 'r') as fin, open(tmpFile, 'wb') as fout:
+            Natoms = int(fin.readline().strip().split()[1])
+            vel_sample_steps = int(fin.readline().strip().split()[1])
+            fin.readline()                                                  # skip comment (Atom ids:)
+            indArray = np.fromfile(fin, dtype=int, count=Natoms, sep=" ")
+            fin.readline()                                                  # skip comment (------)
+            
+            np.array([Natoms, vel_sample_steps, chunkFrames], dtype='<i4').tofile(fout)
+            indArray.astype('<i4').tofile(fout)
+            
+            NDOF = 3 * Natoms
+            while True:                                                     # Stream the velocities chunk by chunk
+                velArray = np.fromfile(fin, dtype=np.dtype('f8'), count=chunkFrames * NDOF, sep=" ")
+                NFrames = np.size(velArray) // NDOF
+                if NFrames * NDOF != np.size(velArray):                     # Incomplete last frame (e.g. interrupted dump)
+                    print("Skipping the incomplete last frame of " + compactFile + ".")
+                if NFrames == 0:
+                    break
+                velArray = np.reshape(velArray[:NFrames * NDOF], (NFrames, NDOF))   # One frame per row in the compact file
+                np.ascontiguousarray(velArray.T, dtype='<f8').tofile(fout)
+        
+        os.replace(tmpFile, binaryFile)
+
+    def _setFrequencyGrid(self):
+        """
+        Set the angular frequency grid ``self.oms_fft`` of the zero-padded chunkSize (truncated after maxFreq) and the standard deviation
+        ``self._sigmaBins`` (in array elements) of the Gaussian smoothing window of width widthWin on that grid.
+        The window is used with gaussian_filter1d(..., truncate=3.0) so that it spans 6*sigma.
+        ``self._omsCalc`` holds the frequencies computed per chunk, i.e. oms_fft and, if maxFreq is given, the half window
+        above it, so that the smoothing below maxFreq sees the actual spectrum instead of zeros.
+        :return: The number of frequencies
+        """
+        
+        '''
+        numpy.fft.fftfreq(n, d=1.0)
+        Return the Discrete Fourier Transform sample frequencies.
+        f = [0, 1, ...,   n/2-1,     -n/2, ..., -1] / (d*n)   if n is even
+        f = [0, 1, ..., (n-1)/2, -(n-1)/2, ..., -1] / (d*n)   if n is odd
+        '''
+        
+        self.oms_fft = np.fft.rfftfreq(self.chunkSize, d=self.sampleTimestep) * 2 * np.pi
+        df = (self.oms_fft[1] - self.oms_fft[0]) / (2 * np.pi)   # Angular frequency, positive val (w is the angular frequency)
     	
-        gwin = np.ceil(widthWin / df)                 # number of array elements in window
+        gwin = np.ceil(self.widthWin / df)            # number of array elements in window
  	  
         if gwin % 2 == 0:                             # make sure its odd sized array
            gwin = gwin+1
            
-        if gwin == 1:
-        	 gauss = np.array([1])                      # if array is size 1, convolve with self
-
-        else:
-           n = 2*np.arange(0,gwin)/(gwin-1)-(1)       # centered at 0, sigma = 1
-           n = (3*n)                                  # set width of profile to 6*sigma i.e. end values ~= 0
-           gauss = np.exp(-np.multiply(n,n)/2.0)      # gaussian fx to convolve with
-           gauss = gauss/np.sum(gauss)                # normalized gaussian
-           
-    	  # Smooth the value           
-        smooth = np.convolve(func, gauss, mode = 'same')
+        self._sigmaBins = (gwin - 1) / 6.0            # 0 if array is size 1, i.e. no smoothing
+        
+        self._omsCalc = self.oms_fft
+        if self.maxFreq is not None:                  # Keep the frequencies up to (and including the first one above) maxFreq
+            kmax = int(np.searchsorted(self.oms_fft, self.maxFreq)) + 1
+            kcalc = kmax + int(3.0 * self._sigmaBins + 0.5)   # Plus the radius of the smoothing window
+            self._omsCalc = self.oms_fft[:kcalc]
+            self.oms_fft = self.oms_fft[:kmax]
         
-        return smooth
+        return np.size(self.oms_fft)
     
     def _differ_direction(self):
+        """
+        Keep only the in_plane or out_of_plane components of Kij. Zeroing the rows (left atoms' velocities) and
+        the columns (right atoms' velocities) of a direction in Kij is the same as zeroing the velocities
+        in that direction, so velsL and velsR are not modified.
+        """
     	
         if self.in_plane and not self.out_of_plane:
     	  	
-    	  	 # Forces in_plane
-    	  	 self.Kij[2::3, :] = 0                                      
-    	  	 	
-    	  	 # Velocity	in_plane                                         # Z-direction velocity
-    	  	 self.velsL[2::3, :] = 0
-    	  	 self.velsR[2::3, :] = 0                                     # The force and velocity in Z-direction set to zero
+           # Forces and velocities in_plane                          # The force and velocity in Z-direction set to zero
+           self.Kij[2::3, :] = 0                                      
+           self.Kij[:, 2::3] = 0
     	  	 
         elif self.out_of_plane and not self.in_plane:
     	  	
-    	  	 # Forces out_of_plane                                       
-           self.Kij[0::3, :] = 0                                       # The force and velocity in X-direction and Y-direction set to zero
+           # Forces and velocities out_of_plane                      # The force and velocity in X-direction and Y-direction set to zero
+           self.Kij[0::3, :] = 0
            self.Kij[1::3, :] = 0
-           	
-           # Velocity	out_of_plane
-           self.velsL[0::3, :] = 0                                     # X-direction velocity
-           self.velsL[1::3, :] = 0                                     # Y-direction velocity (Left velocity)
-           	
-           self.velsR[0::3, :] = 0
-           self.velsR[1::3, :] = 0                                     # Right velocity 	
+           self.Kij[:, 0::3] = 0
+           self.Kij[:, 1::3] = 0
 
         else:
         	 raise AttributeError('Can\'t calculate the spectral decomposition in different'
         	 ' directions at the same time')
     
+    def _planFFTW(self, NDOF):
+        """
+        Create the pyFFTW plan for the zero-padded real FFT of the (NDOF, chunkSize) velocity array.
+        The plan and its aligned buffers are reused for every chunk.
+        """
+        import pyfftw
+        
+        threads = self.fftWorkers if self.fftWorkers > 0 else os.cpu_count() + 1 + self.fftWorkers
+        self._fftIn = pyfftw.empty_aligned((NDOF, self.chunkSize), dtype='float64')
+        self._fftOut = pyfftw.empty_aligned((NDOF, self.chunkSize // 2 + 1), dtype='complex128')
+        self._fftPlan = pyfftw.FFTW(self._fftIn, self._fftOut, axes=(1,), direction='FFTW_FORWARD',
+                                    flags=('FFTW_MEASURE',), threads=max(threads, 1))
+        self._fftIn[:] = 0                              # The planning overwrites the input; the zero padding is kept from here on
+
+    def _setupGPU(self, NDOF):
+        """
+        Allocate the velocity buffer on the GPU and copy Kij (kept on the GPU for all the chunks) and the
+        degree-of-freedom rows of the left and right atoms there.
+        """
+        import cupy as cp
+        
+        self._dVel = cp.empty((NDOF, self._rawChunk), dtype=cp.float64)   # Same layout as velArray
+        self._dKij = cp.asarray(self.Kij)
+        self._dRowsL = cp.asarray(self._rowsL)
+        self._dRowsR = cp.asarray(self._rowsR)
+
     def postProcess(self):
         """
         Calculate the spectral decomposition and store to ``self.SHC_smooth``.
         :return: None
         """
 
-        print("\nReading the compact velocity file " + self.compactVelocityFile + ".")
-        fid = open(self.compactVelocityFile, 'r')
-        s = fid.readline().strip().split()              # Read the Read the first line of the compact_velocity file
-        Natoms = int(s[1])
+        # Start from the chunk size of the binary file (a short first chunk of a previous call changes it)
+        self._rawChunk = self._chunkFrames
+        self.chunkSize = next_fast_len(self._rawChunk, real=True)
+
+        print("\nReading the binary velocity file " + self.binaryVelocityFile + ".")
+        fid = open(self.binaryVelocityFile, 'rb')
+        Natoms, vel_sample_steps, chunkFrames = [int(n) for n in np.frombuffer(fid.read(12), dtype='<i4')]   # Header of the binary file
         if Natoms != self.NL + self.NR:                 # Error checking (Use different error reporting methods)
             raise ValueError('Mismatch in the numbers of atoms '
                                'in the read velocity file and the used force constant file!')
         
-        vel_sample_steps = int(fid.readline().strip().split()[1])       # velocity sample_steps in dump file
+        # vel_sample_steps is the velocity sample_steps in dump file
         if (vel_sample_steps * self.dt_md) != (self.sampleTimestep):    # Error checking
         	 sys.exit('SETTING ERROR: Different dump stride given in '
                  +str(self.compactVelocityFile))
 
-        s = fid.readline()                              # skip comment (Atom ids:)
-        #print('\n' + s)
-        
+        if chunkFrames != self._chunkFrames:                            # Error checking
+            raise ValueError('Mismatch in the chunk sizes of ' + self.binaryVelocityFile + ' and the post-processing, '
+                             'create the SHCPostProc object again to transcode the file!')
+
         # Read the atom ids {Note that these indices (e.g. self.inds_interface) differ from atom IDs (in dump_velocity file) by a factor of one}
          
-        indArray = np.fromfile(fid, dtype=int, count=Natoms, sep=" ")
+        indArray = np.frombuffer(fid.read(4 * Natoms), dtype='<i4')
    
-        for j in range(Natoms):                                         # For error checking
-            if (self.inds_interface[j] + 1) != int(indArray[j]):
-               sys.exit('LAMMPS ERROR: ids in the vels_file don\'t match that in the force_file')
+        if not np.array_equal(self.inds_interface + 1, indArray):      # For error checking
+            sys.exit('LAMMPS ERROR: ids in the vels_file don\'t match that in the force_file')
 
-        s = fid.readline()                              # skip comment (------)
-        #print(s)                                        # The file pointer stays here for now
+        # The file pointer stays at the velocities for now
 
         # Total number (in the interface group) of degrees of freedom
         
         NDOF = 3 * (self.NL + self.NR)
         
-        '''
-        numpy.fft.fftfreq(n, d=1.0)
-        Return the Discrete Fourier Transform sample frequencies.
-        f = [0, 1, ...,   n/2-1,     -n/2, ..., -1] / (d*n)   if n is even
-        f = [0, 1, ..., (n-1)/2, -(n-1)/2, ..., -1] / (d*n)   if n is odd
-        '''
-        
-        self.oms_fft = np.fft.rfftfreq(self.chunkSize, d=self.sampleTimestep) * 2 * np.pi
-        Nfreqs = np.size(self.oms_fft)
+        Nfreqs = self._setFrequencyGrid()                               # Frequency grid and smoothing window, fixed for all chunks
         print('\nThe number of sampling frequencies is {0} and start to Chunk averaging process:'.format(Nfreqs))        
 
         # Initialize the spectral heat current arrays
         self.SHC_smooth = np.zeros(Nfreqs)
-        self.SHC_smooth2 = np.zeros(Nfreqs)
+        self._M2 = np.zeros(Nfreqs)
         self.SHC_average = np.zeros(Nfreqs)
 
         exitFlag = False
-
-        for k in np.arange(self.NChunks):            # Start the iteration over chunks (For average)
-            # for k in range(0,2): (for test)        # Start the iteration over chunks
-            print("\t\tChunk averaging process %d / %d" % (k + 1, self.NChunks))
-            
-            ## ************** Get velocities for each block *************
-            # Read a chunk of velocitites
-            
-            velArray = np.fromfile(fid, dtype=np.dtype('f8'), count=self.chunkSize * NDOF, sep=" ")
-
-            # Prepare for exit if the read size does not match the chunk size
-            if np.size(velArray) == 0:
-                print("Finished the file, exiting.")
-                self.NChunks = k - 1
-                break
-            elif np.size(velArray) != self.chunkSize * NDOF:
-                # Reaching the end of file           
-                self.chunkSize = int(np.size(velArray) / NDOF)
-                if k > 0:  # Not the first chunk
-                    self.NChunks = k - 1
-                    break
-                else:
-                    exitFlag = True
-                    self.oms_fft = np.fft.rfftfreq(self.chunkSize, d=self.sampleTimestep) * 2 * np.pi
-                    Nfreqs = np.size(self.oms_fft)
-                    print("Changing chunk size to " + str(int(np.size(velArray) / NDOF)) + "!")
-
-            # Reshape the array so that each row corresponds to different degree of freedom (e.g. particle 1, direction x, y, z etc.)
+        
+        # Two buffers reused for reading the chunks of velocities: the next chunk is read in the
+        # background into one buffer while the current chunk in the other one is processed
+        velBufs = [np.empty(self._rawChunk * NDOF, dtype='<f8') for i in range(2)]
+        velBytes = [velBuf.view(np.uint8) for velBuf in velBufs]    # Byte views for readinto, no copy
+        readPool = ThreadPoolExecutor(max_workers=1)
+        try:
+            nextRead = readPool.submit(fid.readinto, velBytes[0])
+        
+            if self.useGPU:
+                import cupy as cp
+                import cupyx.scipy.fft as cufft
+                self._setupGPU(NDOF)
+            elif self.useFFTW:
+                self._planFFTW(NDOF)
             
-            velArray = np.reshape(velArray, (NDOF, self.chunkSize), order='F')    # Write in column order
+            if self.useNumba and not self.useGPU:
+                shcKernel = _shcKernel()
 
-            # FFT with respect to the second axis (NOTE THE USE OF RFFT)
-            velFFT = np.fft.rfft(velArray, axis=1)                                 # axis = 0 for rows, axis = 1 for column 
-            velFFT *= self.sampleTimestep
+            for k in np.arange(self.NChunks):            # Start the iteration over chunks (For average)
+                # for k in range(0,2): (for test)        # Start the iteration over chunks
+                print("\t\tChunk averaging process %d / %d" % (k + 1, self.NChunks))
             
-            self.velsL = np.zeros((3 * self.NL, Nfreqs), dtype = np.complex128)
-            self.velsR = np.zeros((3 * self.NR, Nfreqs), dtype = np.complex128)
+                ## ************** Get velocities for each block *************
+                # Read a chunk of velocitites
             
-            ## Atoms on the left (self.ids_L is the left interfacial atom indices)
+                velBuf = velBufs[k % 2]
+                nread = nextRead.result() // velBuf.itemsize
+                if nread % NDOF != 0:                       # A short read must still hold whole frames
+                    raise ValueError('Truncated velocities in ' + self.binaryVelocityFile + ', remove the file to transcode it again!')
+                velArray = velBuf[:nread]
+
+                # Prepare for exit if the read size does not match the chunk size
+                if np.size(velArray) == 0:
+                    print("Finished the file, exiting.")
+                    self.NChunks = k                        # Number of chunks processed
+                    break
+                elif np.size(velArray) != self._rawChunk * NDOF:
+                    # Reaching the end of file           
+                    if k > 0:  # Not the first chunk, the short chunk is dropped and the chunk size is kept
+                        self.NChunks = k
+                        break
+                    else:
+                        exitFlag = True
+                        self._rawChunk = int(np.size(velArray) / NDOF)
+                        self.chunkSize = next_fast_len(self._rawChunk, real=True)
+                        Nfreqs = self._setFrequencyGrid()
+                        if self.useGPU:
+                            self._setupGPU(NDOF)
+                        elif self.useFFTW:
+                            self._planFFTW(NDOF)
+                        print("Changing chunk size to " + str(int(np.size(velArray) / NDOF)) + "!")
+
+                # Prefetch the next chunk
+                if not exitFlag and k + 1 < self.NChunks:
+                    nextRead = readPool.submit(fid.readinto, velBytes[(k + 1) % 2])
+
+                # Reshape the array so that each row corresponds to different degree of freedom (e.g. particle 1, direction x, y, z etc.)
             
-            self.velsL[0::3, :] = velFFT[3 * self.ids_L, :]                     # X-direction velocity
-            self.velsL[1::3, :] = velFFT[3 * self.ids_L + 1, :]                 # Y-direction velocity 
-            self.velsL[2::3, :] = velFFT[3 * self.ids_L + 2, :]                 # Z-direction velocity 
+                velArray = np.reshape(velArray, (NDOF, self._rawChunk))               # C-ordered view, no copy
+
+                # FFT with respect to the second axis (NOTE THE USE OF RFFT), zero-padded to chunkSize
+                if self.useGPU:
+                    self._dVel.set(velArray)
+                    velFFT = cufft.rfft(self._dVel, n=self.chunkSize, axis=1)           # Stays on the GPU
+                elif self.useFFTW:
+                    self._fftIn[:, :self._rawChunk] = velArray
+                    velFFT = self._fftPlan()                                           # Result in self._fftOut
+                else:
+                    velFFT = rfft(velArray, n=self.chunkSize, axis=1, workers=self.fftWorkers)   # axis = 0 for rows, axis = 1 for column 
+                velFFT = velFFT[:, :np.size(self._omsCalc)]                            # Up to maxFreq (if given) and the smoothing margin
+                velFFT *= self.sampleTimestep
 
-            ## Atoms on the right (self.ids_L is the right interfacial atom indices)
-            
-            self.velsR[0::3, :] = velFFT[3 * self.ids_R, :]                     # X-direction velocity
-            self.velsR[1::3, :] = velFFT[3 * self.ids_R + 1, :]                 # Y-direction velocity
-            self.velsR[2::3, :] = velFFT[3 * self.ids_R + 2, :]                 # Z-direction velocity
-            	
-            ## For different direction spectral SHC:
-            if self.in_plane or self.out_of_plane:
-            	
-               self._differ_direction()
-
-            # Spectral heat current for the specific chunk
-            SHC = np.zeros(Nfreqs)
+                # Spectral heat current for the specific chunk
+                SHC = np.zeros(np.size(self._omsCalc))
             
-            '''
-            In formula programming, the SHC here is already the sum of the left and right interface atoms
-            '''
-            for ki in range(1, Nfreqs):                                    # Skip the first one with zero frequency
-                SHC[ki] = -2.0 * np.imag(np.dot(self.velsL[:, ki], np.dot(self.Kij, np.conj(self.velsR[:, ki])))) / self.oms_fft[ki]  # np.dot is the matrix product
-
-            # Normalize correctly
+                '''
+                In formula programming, the SHC here is already the sum of the left and right interface atoms
+                All the frequencies are handled at once. Since Kij is real, with velsL = a + ib and velsR = c + id,
+                Im(velsL * Kij * conj(velsR)) = b * (Kij * c) - a * (Kij * d), i.e. two real matrix products
+                '''
+                if self.useGPU:
+                    ## Same as the BLAS version below with cuBLAS, only the Nfreqs-size result is copied back
+                    d_vL = velFFT[self._dRowsL]
+                    d_vR = velFFT[self._dRowsR]
+                    d_KvRi = cp.dot(self._dKij, cp.ascontiguousarray(d_vR.imag, dtype=cp.float32))
+                    d_KvRr = cp.dot(self._dKij, cp.ascontiguousarray(d_vR.real, dtype=cp.float32))
+                    dots_imag = cp.asnumpy(cp.einsum('ij,ij->j', d_vL.imag, d_KvRr) - cp.einsum('ij,ij->j', d_vL.real, d_KvRi))
+                elif self.useNumba:
+                    dots_imag = np.empty(np.size(self._omsCalc))
+                    shcKernel(velFFT, self.Kij, self._rowsL, self._rowsR, dots_imag)
+                else:
+                    ## Atoms on the left and right (x, y and z velocities of self.ids_L and self.ids_R, gathered at once)
+                    self.velsL = velFFT[self._rowsL]
+                    self.velsR = velFFT[self._rowsR]
+                
+                    vLr, vLi = np.ascontiguousarray(self.velsL.real), np.ascontiguousarray(self.velsL.imag)
+                    # Single precision matrix products (SGEMM) with the float32 Kij, the dot products are summed in double precision
+                    vRr = np.ascontiguousarray(self.velsR.real, dtype=np.float32)
+                    vRi = np.ascontiguousarray(self.velsR.imag, dtype=np.float32)
+                    KvRi = np.dot(self.Kij, vRi)                              # (3 * NL) x Nfreqs
+                    KvRr = np.dot(self.Kij, vRr)
+                    dots_imag = np.einsum('ij,ij->j', vLi, KvRr) - np.einsum('ij,ij->j', vLr, KvRi)   # For each frequency
+                SHC[1:] = -2.0 * dots_imag[1:] / self._omsCalc[1:]            # Skip the first one with zero frequency
+
+                # Normalize correctly (by the length of the signal, not of the zero-padded FFT)
             
-            SHC /= (self.chunkSize * self.sampleTimestep)
+                SHC /= (self._rawChunk * self.sampleTimestep)
 
-            # Change units           
+                # Change units           
 
-            SHC *= self.scaleFactor
+                SHC *= self.scaleFactor
             
-            # Copy the SHC value before modifying it
+                # Copy the SHC value before modifying it
             
-            SHC_orig = SHC.copy()
+                SHC_orig = SHC.copy()
             
-            # Smooth the value           
+                # Smooth the value (Gaussian filter, zero outside the frequency grid)
             
-            df = (self.oms_fft[1] - self.oms_fft[0]) / (2 * np.pi)     # Angular frequency, positive val (w is the angular frequency)
-            SHC = self._smoothen(SHC, df, self.widthWin)
-
-            # Time average
-            if not exitFlag:                                           # If Nfreqs has changed, the running averaging cannot be performed
-                self.SHC_smooth = (k * self.SHC_smooth + SHC) / (k + 1.0)
-                # The square
-                self.SHC_smooth2 = (k * self.SHC_smooth2 + SHC ** 2) / (k + 1.0)
-                # The non-smoothened average
-                self.SHC_average = (k * self.SHC_average + SHC_orig) / (k + 1.0)
-                if self.backupPrefix is not None:
-                    np.save(self.backupPrefix + '_backup_oms.npy', self.oms_fft)
-                    np.save(self.backupPrefix + '_backup_SHC.npy', self.SHC_smooth)
-                    import cPickle as pickle
-                    with open(self.backupPrefix + '_run_PP.pckl', 'w') as pf:
-                        pickle.dump(self, pf)
-            elif exitFlag and k == 0:    # First chunk and new chunk size, needs re-initializing the vectors as Nfreqs may have changed
-                self.SHC_smooth = SHC
-                self.SHC_smooth2 = SHC ** 2
-                self.SHC_average = SHC_orig
-                self.NChunks = 1
-                break
-            else:                        # This should never be reached
-                assert False, "SHCPostProc should not reach here (exitFlag=True and k>0)."
+                if self._sigmaBins > 0:
+                    SHC = gaussian_filter1d(SHC, self._sigmaBins, mode='constant', truncate=3.0)
+                
+                # Drop the smoothing margin above maxFreq (if given)
+                SHC = SHC[:Nfreqs]
+                SHC_orig = SHC_orig[:Nfreqs]
+
+                # Time average (Welford's online algorithm for the mean and the sum of squared deviations)
+                if not exitFlag:                                           # If Nfreqs has changed, the running averaging cannot be performed
+                    delta = SHC - self.SHC_smooth
+                    self.SHC_smooth += delta / (k + 1.0)
+                    SHC -= self.SHC_smooth                                 # Deviation from the updated mean
+                    self._M2 += delta * SHC
+                    # The non-smoothened average
+                    SHC_orig -= self.SHC_average
+                    self.SHC_average += SHC_orig / (k + 1.0)
+                    if self.backupPrefix is not None:   # Only the small arrays needed to resume, not the whole object
+                        np.savez_compressed(self.backupPrefix + '_backup.npz', oms=self.oms_fft, smooth=self.SHC_smooth,
+                                            M2=self._M2, average=self.SHC_average, chunks=k + 1)
+                elif exitFlag and k == 0:    # First chunk and new chunk size, needs re-initializing the vectors as Nfreqs may have changed
+                    self.SHC_smooth = SHC
+                    self._M2 = np.zeros(Nfreqs)
+                    self.SHC_average = SHC_orig
+                    self.NChunks = 1
+                    break
+                else:                        # This should never be reached
+                    assert False, "SHCPostProc should not reach here (exitFlag=True and k>0)."
+
+        finally:                                        # Also on errors: stop the read thread and close the file
+            readPool.shutdown(wait=True)
+            fid.close()
 
         # Calculate the error estimate at each frequency from the between-chunk variances
         
         if self.NChunks > 1:
             print("\nCalculating error estimates.")
-            samplevar = (self.NChunks / (self.NChunks - 1.0)) * (self.SHC_smooth2 - self.SHC_smooth ** 2)
-            self.SHC_error = np.sqrt(samplevar) / np.sqrt(self.NChunks)
+            samplevar = self._M2 / (self.NChunks - 1.0)
+            self.SHC_error = np.sqrt(samplevar / self.NChunks)
             
             #print('\nThe estimated error of the between-chunk variance is {}.'.format(self.SHC_error))
             
@@ -502,7 +713,6 @@ if __name__ == "__main__":
     # Plotting if available
     
     import matplotlib.pylab as plt
-    import scipy.integrate as sci                                                    # For calculate the area 
     
     # Unit conversion
     x_Frequency = postprocessor.oms_fft/(2*np.pi*1.0e12)                             # Conversion from Hz to THz
@@ -514,14 +724,10 @@ if __name__ == "__main__":
     # Calculate the phonon transmission T(w)                           
     T_w = postprocessor.SHC_smooth / (Kb * Tem_jump)                 # Dimensionless
     
-    # Calculate the accumulated thermal conductance
-    Freq_number = len(x_Frequency)
-    accumulated_ITC = []
-    accumulated_count = 0
-    
-    for i in range(Freq_number):
-        accumulated_count = sci.trapz(y_ITC[0:i], x_Frequency[0:i])
-        accumulated_ITC.append(accumulated_count)
+    # Calculate the accumulated thermal conductance (cumulative trapezoidal rule)
+    trap = 0.5 * (y_ITC[1:] + y_ITC[:-1]) * np.diff(x_Frequency)
+    accumulated_ITC = np.concatenate(([0.0], np.cumsum(trap)))
+    accumulated_count = accumulated_ITC[-1]
     
     print('\nThe accumulated thermal conductance is ' + str(accumulated_count) + ' (GW/m^2/K)')
      
@@ -547,7 +753,7 @@ if __name__ == "__main__":
     plt.ylabel('G(w) (GW/m^2/K/THz)')
     plt.xlim(0, max(x_Frequency))                             # Frequency range
     plt.ylim(0, max(y_ITC)+(max(y_ITC)/5))                    # It depends on your case
-    print('\nThe total thermal conductance is (total area)' + str(sci.trapz(y_ITC, x_Frequency)) + ' (GW/m^2/K)\n')   
+    print('\nThe total thermal conductance is (total area)' + str(accumulated_count) + ' (GW/m^2/K)\n')   
     plt.legend(fontsize=15, loc='best')          
     plt.savefig(fileprefix+'_SHC.png')
     plt.show()